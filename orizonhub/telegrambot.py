@@ -3,19 +3,48 @@
 
 import os
 import re
-import json
 import time
+import random
 import logging
+import functools
+import threading
+from urllib.parse import quote_plus
 
 from .model import __version__, Protocol, Message, User, UserType, Response
 from .utils import mdescape, timestring_a, smartname, fwd_to_text, sededit, LimitedSizeDict
 
 import requests
 
+try:
+    # decodes bytes directly, much faster on big getUpdates batches
+    import orjson as jsonlib
+except ImportError:
+    import json as jsonlib
+
+try:
+    # streams multipart uploads from disk instead of buffering the whole
+    # file in memory as requests does with `files=`
+    from requests_toolbelt import MultipartEncoder
+except ImportError:
+    MultipartEncoder = None
+
+try:
+    # RE2's DFA engine beats the backtracking stdlib re on these small
+    # alternations, which run on every bridged message
+    import re2 as re_engine
+except ImportError:
+    re_engine = re
+
 logger = logging.getLogger('tgbot')
 
-re_ircfmt = re.compile('([\x02\x1D\x1F\x16\x0F\x06]|\x03(?:\d+(?:,\d+)?)?)')
-re_http = re.compile(r'^\s*(ht|f)tps?://')
+re_ircfmt = re_engine.compile('([\x02\x1D\x1F\x16\x0F\x06]|\x03(?:\d+(?:,\d+)?)?)')
+re_http = re_engine.compile(r'^\s*(ht|f)tps?://')
+
+# bold, reverse, italics, underline, color
+_ircfmt_idx = {'\x02': 0, '\x16': 1, '\x1D': 2, '\x1F': 3, '\x03': 4}
+# Markdown code for the lowest (= highest priority) set bit of the
+# packed state: '**__*' in bit order, '' when nothing is active
+_ircfmt_md = {0: '', 1: '*', 2: '*', 4: '_', 8: '_', 16: '*'}
 
 def ircfmt2tgmd(s):
     '''
@@ -25,26 +54,33 @@ def ircfmt2tgmd(s):
         [text](URL)
         `inline fixed-width code`
         ```pre-formatted fixed-width code block```
+    Returns (converted, had_fmt): had_fmt tells whether any format code
+    was seen, so callers don't need a separate re_ircfmt.search pass.
     '''
-    table = ('\x02\x16\x1D\x1F\x03', '**__*')
-    # bold, reverse, italics, underline, color
-    state = [False]*5
+    state = 0
     code = ''
     ret = []
-    for chunk in re_ircfmt.split(s):
-        if not chunk:
-            pass
-        elif chunk[0] in table[0]:
-            idx = table[0].index(chunk[0])
-            if chunk[0] == '\x03':
-                state[idx] = bool(chunk[1:])
+    pos = 0
+    had_fmt = False
+    for m in re_ircfmt.finditer(s):
+        had_fmt = True
+        chunk = s[pos:m.start()]
+        pos = m.end()
+        if chunk:
+            if code and re_http.match(chunk):
+                # Telegram don't support escape within a format code
+                ret.pop()
+                code = ''
+            ret.append(mdescape(chunk))
+        ctrl = m.group()
+        idx = _ircfmt_idx.get(ctrl[0])
+        if idx is not None:
+            if ctrl[0] == '\x03':
+                state = state | 16 if ctrl[1:] else state & ~16
             else:
-                state[idx] = not state[idx]
-            newcode = ''
-            for k, v in enumerate(state):
-                if v:
-                    newcode = table[1][k]
-                    break
+                state ^= 1 << idx
+            # state & -state isolates the lowest set bit
+            newcode = _ircfmt_md[state & -state]
             if code != newcode:
                 if ret and ret[-1] == code:
                     ret.pop()
@@ -52,24 +88,49 @@ def ircfmt2tgmd(s):
                     ret.append(code)
                 ret.append(newcode)
                 code = newcode
-        elif chunk[0] == '\x0F':
-            state = [False]*5
+        elif ctrl[0] == '\x0F':
+            state = 0
             ret.append(code)
             code = ''
-        elif chunk[0] == '\x06':
-            # blink
-            pass
-        elif code:
+        # '\x06' (blink) is ignored
+    chunk = s[pos:]
+    if chunk:
+        if code and re_http.match(chunk):
             # Telegram don't support escape within a format code
-            if re_http.match(chunk):
-                ret.pop()
-                code = ''
-            ret.append(mdescape(chunk))
-        else:
-            ret.append(mdescape(chunk))
+            ret.pop()
+            code = ''
+        ret.append(mdescape(chunk))
     if code:
         ret.append(code)
-    return ''.join(ret)
+    return ''.join(ret), had_fmt
+
+def _encode_sendmessage(chat_id, text, reply_to_message_id=None, **params):
+    '''
+    Specialized urlencoder for the hot sendMessage path: formats the
+    known keys straight into a bytes body instead of walking a dict
+    through the generic urlencode in `requests`.
+    '''
+    buf = bytearray(b'chat_id=')
+    buf += str(chat_id).encode('ascii')
+    buf += b'&text='
+    buf += quote_plus(text).encode('ascii')
+    if reply_to_message_id:
+        buf += b'&reply_to_message_id='
+        buf += str(reply_to_message_id).encode('ascii')
+    for k, v in params.items():
+        if v is not None:
+            buf += b'&'
+            buf += k.encode('ascii')
+            buf += b'='
+            buf += quote_plus(str(v)).encode('ascii')
+    return bytes(buf)
+
+@functools.lru_cache(maxsize=2048)
+def _intern_user(utype, pid, username, first_name, last_name):
+    # a batch of group messages repeats the same few senders; reuse the
+    # User tuple instead of allocating a fresh one per occurrence
+    return User(None, 'telegram', utype, pid, username,
+                first_name, last_name, None)
 
 class BotAPIFailed(Exception):
     pass
@@ -93,9 +154,12 @@ class TelegramBotProtocol(Protocol):
         self.pastebin = bus.pastebin
         self.url = 'https://api.telegram.org/bot%s/' % self.cfg.token
         self.url_file = 'https://api.telegram.org/file/bot%s/' % self.cfg.token
-        self.hsession = requests.Session()
-        self.useragent = 'OrizonHub/%s %s' % (__version__, self.hsession.headers["User-Agent"])
-        self.hsession.headers["User-Agent"] = self.useragent
+        self.useragent = 'OrizonHub/%s %s' % (
+            __version__, requests.utils.default_user_agent())
+        # getUpdates long-polls on its own session and thread, so sends
+        # running on the executor never wait behind it (and vice versa)
+        self.hsession = self._new_session()
+        self.psession = self._new_session()
         self.run = True
         self.forward_enabled = True
         # If you're sending bulk notifications to multiple users, the API will not
@@ -103,9 +167,21 @@ class TelegramBotProtocol(Protocol):
         # notifications over large intervals of 8—12 hours for best results.
         # Also note that your bot will not be able to send more than 20 messages
         # per minute to the same group.
+        # Telegram's limits are per chat, so keep one bucket per
+        # destination; `None` collects the methods without a chat_id.
         self.rate = 20/60 # 1/30
         self.attempts = 2
-        self.last_sent = 0
+        self.rate_lock = threading.Lock()
+        self.chat_last_sent = {}
+        # at most 5 requests in flight towards the API
+        self.send_sem = threading.BoundedSemaphore(5)
+        # coalesce bursts of plain-text forwards to one chat into a
+        # single sendMessage, so chatty IRC channels don't exhaust the
+        # 20 msg/min group budget one line at a time
+        self.coalesce_delay = 0.3
+        self.coalesce_lock = threading.Lock()
+        self.coalesce_buf = {}    # chat_id -> [text, ...]
+        self.coalesce_timer = {}  # chat_id -> threading.Timer
         # updated later
         self.identity = User(None, 'telegram', UserType.user,
                              int(self.cfg.token.split(':')[0]), self.cfg.username,
@@ -114,6 +190,10 @@ class TelegramBotProtocol(Protocol):
         self.dest = User(None, 'telegram', UserType.group, self.cfg.groupid,
                          None, config.group_name, None, config.group_name)
         self.msghistory = LimitedSizeDict(size_limit=10)
+        # expose API methods as real attributes so calls like self.getFile
+        # don't go through __getattr__ and allocate a closure each time
+        for m in self.METHODS:
+            setattr(self, m, functools.partial(self.bot_api, m))
 
     def start_polling(self):
         self.identity = self._make_user(self.bot_api('getMe'))
@@ -128,15 +208,20 @@ class TelegramBotProtocol(Protocol):
                 self.bus.handler.state.get('tgapi.offset', 0))
             try:
                 updates = self.bot_api('getUpdates',
-                    offset=self.bus.handler.state.get('tgapi.offset', 0), timeout=10)
+                    offset=self.bus.handler.state.get('tgapi.offset', 0),
+                    timeout=50,
+                    # drop channel posts, inline queries etc. server-side;
+                    # edited_message is kept for the <edit> diff display
+                    allowed_updates='["message","edited_message"]')
             except Exception:
                 logging.exception('TelegramBot: Get updates failed.')
                 continue
             if updates:
                 logging.debug('TelegramBot: %r.', updates)
-                maxupd = 0
+                # updates come in ascending update_id order
+                self.bus.handler.state['tgapi.offset'] = \
+                    updates[-1]['update_id'] + 1
                 for upd in updates:
-                    maxupd = max(maxupd, upd['update_id'])
                     if 'message' in upd:
                         msg = self._make_message(upd['message'], True)
                     elif 'edited_message' in upd:
@@ -149,8 +234,6 @@ class TelegramBotProtocol(Protocol):
                         msg.src.pid in self.cfg.ignored_user):
                         continue
                     self.bus.post(msg)
-                self.bus.handler.state['tgapi.offset'] = maxupd + 1
-            time.sleep(.2)
 
     def send(self, response: Response, protocol: str, forwarded: Message) -> Message:
         rinfo = response.info or {}
@@ -187,13 +270,19 @@ class TelegramBotProtocol(Protocol):
             #text = fwd_to_text(fmsgs, self.bus.timezone)
         elif rtype in ('photo', 'audio', 'document', 'sticker', 'video', 'voice'):
             fn = rinfo['media'].get('_file')
+            fp = None
             if fn:
-                input_file = {rtype: (os.path.basename(fn), open(fn, 'rb'))}
+                fp = open(fn, 'rb')
+                input_file = {rtype: (os.path.basename(fn), fp)}
             else:
                 # kwargs[rtype] must be filled
                 input_file = None
-            m = self.bot_api('send' + rtype.capitalize(),
-                chat_id=response.reply.chat.pid, input_file=input_file, **kwargs)
+            try:
+                m = self.bot_api('send' + rtype.capitalize(),
+                    chat_id=response.reply.chat.pid, input_file=input_file, **kwargs)
+            finally:
+                if fp:
+                    fp.close()
             return self._make_message(m)
         elif rtype == 'location':
             m = self.bot_api('sendLocation',
@@ -209,6 +298,7 @@ class TelegramBotProtocol(Protocol):
             return None
         if protocol.startswith('telegram'):
             try:
+                self._flush_chat(self.dest.pid)
                 m = self.bot_api('forwardMessage', chat_id=self.dest.pid,
                     from_chat_id=msg.chat.id, message_id=msg.pid)
                 return self._make_message(m)
@@ -219,19 +309,24 @@ class TelegramBotProtocol(Protocol):
             text = '[%s] Fwd %s: %s' % (smartname(msg.src), smartname(msg.fwd_src), msg.text)
         elif msg.reply:
             text = '[%s] %s: %s' % (smartname(msg.src), smartname(msg.reply.src), msg.text)
-        elif re_ircfmt.search(msg.text):
-            content = ircfmt2tgmd(msg.text)
-            try:
-                content = self.bus.irc.identify_mention(content, True)
-            except KeyError:
-                pass
-            text = '\\[%s] %s' % (smartname(msg.src), content)
-            parse_mode = 'Markdown'
         else:
-            if smartname(msg.src).startswith("slacko"):
+            content, had_fmt = ircfmt2tgmd(msg.text)
+            if had_fmt:
+                try:
+                    content = self.bus.irc.identify_mention(content, True)
+                except KeyError:
+                    pass
+                text = '\\[%s] %s' % (smartname(msg.src), content)
+                parse_mode = 'Markdown'
+            elif smartname(msg.src).startswith("slacko"):
                 text = msg.alttext or msg.text
             else:
                 text = '[%s] %s' % (smartname(msg.src), msg.alttext or msg.text)
+        if parse_mode is None:
+            # buffered; flushed in a batch after coalesce_delay
+            self._queue_send(self.dest.pid, text)
+            return None
+        self._flush_chat(self.dest.pid)
         m = self.bot_api('sendMessage', chat_id=self.dest.pid, text=text,
             parse_mode=parse_mode)
         return self._make_message(m)
@@ -239,31 +334,118 @@ class TelegramBotProtocol(Protocol):
     def status(self, dest, action):
         return self.bot_api('sendChatAction', chat_id=dest.pid, action=action)
 
+    def _queue_send(self, chat_id, text):
+        flush = False
+        with self.coalesce_lock:
+            buf = self.coalesce_buf.setdefault(chat_id, [])
+            buf.append(text)
+            if sum(len(t) for t in buf) > 3584:
+                # near the 4096 limit, don't wait for the timer
+                flush = True
+            elif chat_id not in self.coalesce_timer:
+                timer = threading.Timer(
+                    self.coalesce_delay, self._flush_chat, (chat_id,))
+                timer.daemon = True
+                self.coalesce_timer[chat_id] = timer
+                timer.start()
+        if flush:
+            self._flush_chat(chat_id)
+
+    def _flush_chat(self, chat_id):
+        with self.coalesce_lock:
+            timer = self.coalesce_timer.pop(chat_id, None)
+            if timer:
+                timer.cancel()
+            buf = self.coalesce_buf.pop(chat_id, None)
+        if not buf:
+            return
+        text = '\n'.join(buf)
+        if len(text) > 4096:
+            text = text[:4095] + '…'
+        try:
+            self.bot_api('sendMessage', chat_id=chat_id, text=text)
+        except Exception:
+            logging.exception('TelegramBot: flush to %s failed.', chat_id)
+
     def close(self):
+        for chat_id in list(self.coalesce_buf):
+            self._flush_chat(chat_id)
         self.run = False
 
-    def bot_api(self, method, input_file=None, **params):
-        wait = self.rate - time.perf_counter() + self.last_sent
-        if wait > 0:
-            time.sleep(wait)
+    def _rate_wait(self, chat_id):
+        '''
+        Reserve the next send slot for `chat_id` and sleep until it is
+        due. Distinct chats have independent buckets, so sends to
+        different destinations do not queue behind each other.
+        '''
+        with self.rate_lock:
+            now = time.perf_counter()
+            start = max(now, self.chat_last_sent.get(chat_id, 0) + self.rate)
+            self.chat_last_sent[chat_id] = start
+        if start > now:
+            time.sleep(start - now)
+
+    def bot_api(self, method, input_file=None, data=None, **params):
+        # `data` is a pre-encoded x-www-form-urlencoded body; when given,
+        # `params` is ignored for the request itself
+        # the long poll is not subject to the send rate limit, so it can
+        # run in parallel with outgoing messages
+        polling = (method == 'getUpdates')
+        chat_id = params.get('chat_id')
+        if not polling:
+            self._rate_wait(chat_id)
         att = 1
         ret = None
         while att <= self.attempts and self.run:
+            session = self.psession if polling else self.hsession
             try:
-                req = self.hsession.post(self.url + method, data=params,
-                                         files=input_file,
-                                         timeout=(params.get('timeout', 0)+20))
+                if not polling:
+                    self.send_sem.acquire()
+                try:
+                    if data is not None:
+                        req = session.post(self.url + method, data=data,
+                            headers={'Content-Type':
+                                     'application/x-www-form-urlencoded'},
+                            timeout=(params.get('timeout', 0)+20))
+                    elif input_file and MultipartEncoder is not None:
+                        fields = {k: str(v) for k, v in params.items()
+                                  if v is not None}
+                        fields.update(input_file)
+                        enc = MultipartEncoder(fields=fields)
+                        req = session.post(self.url + method, data=enc,
+                            headers={'Content-Type': enc.content_type},
+                            timeout=(params.get('timeout', 0)+20))
+                    else:
+                        req = session.post(self.url + method, data=params,
+                                           files=input_file,
+                                           timeout=(params.get('timeout', 0)+20))
+                finally:
+                    if not polling:
+                        self.send_sem.release()
                 retjson = req.content
-                ret = json.loads(retjson.decode('utf-8'))
-                break
+                ret = jsonlib.loads(retjson)
             except Exception as ex:
                 if att < self.attempts:
-                    time.sleep((att+1) * 2)
+                    # jittered exponential backoff, so retrying threads
+                    # don't hit the API at the same moment again
+                    time.sleep(random.uniform(0.5, 2 ** att))
                     self.change_session()
                 else:
                     raise ex
-            att += 1
-        self.last_sent = time.perf_counter()
+                att += 1
+                continue
+            if (not ret['ok'] and ret.get('error_code') == 429
+                    and att < self.attempts):
+                # flood control: push this chat's bucket forward and retry
+                retry_after = (ret.get('parameters') or {}).get('retry_after', 1)
+                with self.rate_lock:
+                    self.chat_last_sent[chat_id] = (
+                        time.perf_counter() + retry_after)
+                time.sleep(retry_after)
+                ret = None
+                att += 1
+                continue
+            break
         if ret is None:
             raise BotAPIFailed('attempt = %s, self.run = %s', att, self.run)
         elif not ret['ok']:
@@ -280,13 +462,10 @@ class TelegramBotProtocol(Protocol):
         if len(text) > 2048:
             text = text[:2047] + '…'
         reply_id = reply_to_message_id or None
-        return self.bot_api('sendMessage', chat_id=chat_id, text=text, reply_to_message_id=reply_id, **kwargs)
-
-    def __getattr__(self, name):
-        if name in self.METHODS:
-            return lambda **kwargs: self.bot_api(name, **kwargs)
-        else:
-            raise AttributeError
+        # keep buffered forwards ahead of this message
+        self._flush_chat(chat_id)
+        body = _encode_sendmessage(chat_id, text, reply_id, **kwargs)
+        return self.bot_api('sendMessage', data=body, chat_id=chat_id)
 
     def _parse_media(self, media):
         mt = media.keys() & frozenset(('audio', 'document', 'sticker', 'video', 'voice'))
@@ -298,7 +477,8 @@ class TelegramBotProtocol(Protocol):
             if mt == 'sticker':
                 file_ext = '.webp'
         elif 'photo' in media:
-            photo = max(media['photo'], key=lambda x: x['width'])
+            # the API returns photo sizes in ascending order
+            photo = media['photo'][-1]
             file_id = photo['file_id']
             file_size = photo.get('file_size')
             file_ext = '.jpg'
@@ -317,16 +497,18 @@ class TelegramBotProtocol(Protocol):
         else:
             return ('', '', 0)
 
-    def servemedia(self, media):
+    def servemedia(self, media, resolve=True):
         '''
         Reply type and link of media. This only generates links for photos.
+        `resolve=False` skips the paste link, which needs a getFile API
+        round trip per media message.
         '''
         if not media:
             return ''
-        media_type = tuple((k,v) for k,v in media.items() if k not in ('forward_from_chat', 'entities', 'edit_date'))
-        if media_type:
-            ftype, fval = media_type[0]
-        else:
+        ftype, fval = next(((k,v) for k,v in media.items()
+            if k not in ('forward_from_chat', 'entities', 'edit_date')),
+            (None, None))
+        if ftype is None:
             return ''
         ret = '<%s>' % ftype
         if 'new_chat_title' in media:
@@ -348,21 +530,22 @@ class TelegramBotProtocol(Protocol):
                         fval['location']['latitude'], fval['location']['longitude'])
             elif ftype == 'sticker' and fval.get('emoji'):
                 ret = fval['emoji'] + ' ' + ret
-            try:
-                ret += ' ' + self.bus.pastebin.paste_url(*self._parse_media(media))
-            except (TypeError, NotImplementedError):
-                # _parse_media returned None
-                pass
-            except Exception:
-                # ValueError, FileNotFoundError or network problems
-                logging.exception("can't paste a file: %s", media)
+            if resolve:
+                try:
+                    ret += ' ' + self.bus.pastebin.paste_url(*self._parse_media(media))
+                except (TypeError, NotImplementedError):
+                    # _parse_media returned None
+                    pass
+                except Exception:
+                    # ValueError, FileNotFoundError or network problems
+                    logging.exception("can't paste a file: %s", media)
         return ret
 
-    def _make_message(self, obj, memorize=False):
+    def _make_message(self, obj, memorize=False, resolve_media=True):
         if obj is None:
             return None
         chat = self._make_user(obj['chat'])
-        media = {k:obj[k] for k in frozenset(obj.keys()).difference(self.STATIC_FIELDS)}
+        media = {k:v for k,v in obj.items() if k not in self.STATIC_FIELDS}
         if chat.pid == self.dest.pid:
             self.dest = chat
             mtype = 'group'
@@ -372,7 +555,7 @@ class TelegramBotProtocol(Protocol):
             # other group or channel
             mtype = 'othergroup'
         text = text2 = obj.get('text') or obj.get('caption', '')
-        alttext = self.servemedia(media)
+        alttext = self.servemedia(media, resolve_media)
         if 'edit_date' in media:
             origtext = self.msghistory.get(obj['message_id'])
             if origtext and '\n' not in text:
@@ -391,7 +574,9 @@ class TelegramBotProtocol(Protocol):
             self._make_user(obj.get('from') or obj['chat']),
             chat, text, media, obj['date'],
             self._make_user(obj.get('forward_from')), obj.get('forward_date'),
-            self._make_message(obj.get('reply_to_message')), mtype, alttext or None
+            # don't spend a getFile round trip on the quoted message
+            self._make_message(obj.get('reply_to_message'), resolve_media=False),
+            mtype, alttext or None
         )
 
     @staticmethod
@@ -406,13 +591,29 @@ class TelegramBotProtocol(Protocol):
             else:
                 utype = UserType.channel
         else:
-            utype = UserType.user        
-        return User(None, 'telegram', utype, obj['id'], obj.get('username'),
-                    obj.get('first_name') or obj.get('title'),
-                    obj.get('last_name'), None)
+            utype = UserType.user
+        return _intern_user(utype, obj['id'], obj.get('username'),
+                            obj.get('first_name') or obj.get('title'),
+                            obj.get('last_name'))
+
+    def _new_session(self):
+        s = requests.Session()
+        s.headers["User-Agent"] = self.useragent
+        # enough keep-alive connections for the send semaphore, so
+        # concurrent sends don't re-handshake TLS
+        s.mount('https://', requests.adapters.HTTPAdapter(
+            pool_connections=2, pool_maxsize=10))
+        try:
+            # open the TCP/TLS connection early; the first real API call
+            # then reuses it instead of paying for the handshake
+            s.head('https://api.telegram.org/', timeout=5)
+        except Exception:
+            pass
+        return s
 
     def change_session(self):
         self.hsession.close()
-        self.hsession = requests.Session()
-        self.hsession.headers["User-Agent"] = self.useragent
+        self.psession.close()
+        self.hsession = self._new_session()
+        self.psession = self._new_session()
         logging.warning('Session changed.')